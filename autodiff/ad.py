@@ -1,62 +1,178 @@
+import numbers
+import threading
 import numpy as np
 
+try:
+    from numba import get_num_threads, njit, prange
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+    # Numba is optional, without it the tape kernels run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+
+    def get_num_threads():
+        return 1
+
+# Operation codes used by the array form of a CompiledGraph
+ADD, SUB, MUL, DIV, VAR, CONST, SIN, COS, EXP, LOG = range(10)
+
+# Array feeds go to the per-sample batch kernels only when Numba has at least
+# this many threads. A rough cutoff: on a single core NumPy's vectorized ops
+# were faster than the kernels, and where the crossover lies depends on the
+# machine and the graph. Both paths return the same shapes and dtypes.
+BATCH_MIN_THREADS = 4
+
+
+def _batch_result(result, graph, feed_dict):
+    '''Returns result as a new array of the broadcast shape of the values
+    the variables of graph take in feed_dict.'''
+    values = graph._feed(feed_dict)
+    shape = np.broadcast_shapes(np.shape(result),
+                                *[np.shape(v) for v in values])
+    # The result may be a fed array or an array constant, e.g. for x + 0
+    inputs = values + [node.val for node, _ in graph.tape
+                       if isinstance(node, Constant)]
+    if np.shape(result) != shape or any(np.may_share_memory(result, v)
+                                        for v in inputs):
+        return np.broadcast_to(result, shape).copy()
+    return np.asarray(result)
+
+
+def _constant_value(expr):
+    '''Returns the value of expr if it is a numeric Constant, else None.'''
+    if isinstance(expr, Constant) and isinstance(expr.val, numbers.Number):
+        return expr.val
+    return None
+
 
 class Expression(object):
     '''Base expression class that represents anything in our computational
     graph. Everything should be one of these.'''
+    # Graphs can hold many nodes, keep them free of a per-instance __dict__
+    __slots__ = ('grad', 'children', '_compiled')
+    # Operations also define _source and _d_source: format strings giving
+    # their value and derivative as Python expressions of the children's
+    # values ({0}, {1}), the children's derivatives ({d0}, {d1}) and their
+    # own value ({res}), used to generate code for a CompiledGraph
+
     def __init__(self, grad=False):
         self.grad = grad
         self.children = []
+        self._compiled = None
+
+    def compile(self):
+        '''Builds the CompiledGraph of this expression on first use and
+        returns it. The graph never changes once built, so every later eval,
+        d or backward call reuses the same one.'''
+        if self._compiled is None:
+            self._compiled = CompiledGraph(self)
+        return self._compiled
 
     def eval(self, feed_dict):
         '''Evaluates the entire computation graph given a dictionary of
         variables mapped to values.'''
-        return self._eval(feed_dict, dict())
-    
-    def _eval(self, feed_dict, cache_dict):
-        '''Helper - Evaluates the computation graph recursively.'''
+        return self.compile().eval(feed_dict)
+
+    def _op(self, *args):
+        '''Helper - Computes the value of this node alone from the values of
+        its children, in order. Variables are looked up by the compiled graph
+        instead.'''
         raise NotImplementedError
 
     def d(self, feed_dict):
         '''Evaluates the derivative at the points given, returns to user'''
-        return self._d(feed_dict, dict(), dict())
+        return self.compile().d(feed_dict)
+
+    def eval_batch(self, feed_dict):
+        '''Evaluates the graph at many samples in one pass. feed_dict maps
+        variables to NumPy arrays of samples, which are broadcast against each
+        other (scalars apply to every sample). Every operation runs once on
+        whole arrays rather than once per sample. Always returns a new array
+        of the broadcast shape, even when the result doesn't depend on the
+        samples.'''
+        graph = self.compile()
+        return _batch_result(graph.eval(feed_dict), graph, feed_dict)
+
+    def d_batch(self, feed_dict):
+        '''Evaluates the derivative at many samples in one pass, with the
+        same contract as eval_batch.'''
+        graph = self.compile()
+        return _batch_result(graph.d(feed_dict), graph, feed_dict)
+
+    def backward(self, feed_dict, checkpoint_every=None):
+        '''Evaluates the gradient with respect to every variable in a single
+        reverse sweep, returns a dictionary mapping each Variable to its
+        partial derivative. With checkpoint_every=k only every k-th
+        intermediate value is kept and the rest are recomputed during the
+        sweep, trading time for memory on large graphs.'''
+        return self.compile().backward(feed_dict, checkpoint_every)
+
+    def _tangent(self, value):
+        '''Helper - Derivative of a variable with respect to the input
+        direction d() differentiates along, given its value.'''
+        raise NotImplementedError
+
+    def _signature(self, args):
+        '''Helper - Hashable key equal for nodes that compute the same value,
+        given the tape positions of the children.'''
+        return (self._kind, self.grad, tuple(args))
 
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        '''Helper - Evaluates the differentiation products recursively.
-        @param: feed_dict: dictionary mapping var names 
-        @param: e_cache_dict: cache for previously evaluated values
-        @param: d_cache_dict: cache for previously calculated derivatives
+    def _partials(self, res, *args):
+        '''Helper - Local partial derivatives of this node with respect to
+        each of its children.
+        @param: res: value of this node
+        @param: args: values of the children, in order
         '''
         raise NotImplementedError
 
+    def _topo_order(self):
+        '''Helper - Lists every node of the graph once, children first.'''
+        order = []
+        visited = set()
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+            elif id(node) not in visited:
+                visited.add(id(node))
+                stack.append((node, True))
+                for child in reversed(node.children):
+                    stack.append((child, False))
+        return order
+
     def __add__(self, other):
         try:
             # Propagate the need for gradient if one thing needs gradient
             # Need to call other.grad first since self.grad may shortcircuit
-            return Addition(self, other, grad=(other.grad and self.grad))
+            return Addition.make(self, other, grad=(other.grad or self.grad))
         except AttributeError:
-            return Addition(self, Constant(other), grad=self.grad)
+            return Addition.make(self, Constant(other), grad=self.grad)
     
     def __radd__(self, other):
         return self.__add__(other)
 
     def __sub__(self, other):
         try:
-            return Subtraction(self, other, grad=(other.grad and self.grad))
+            return Subtraction.make(self, other, grad=(other.grad or self.grad))
         except AttributeError:
-            return Subtraction(self, Constant(other), grad=self.grad)
+            return Subtraction.make(self, Constant(other), grad=self.grad)
 
     def __rsub__(self, other):
         try:
-            return Subtraction(other, self, grad=(other.grad and self.grad))
+            return Subtraction.make(other, self, grad=(other.grad or self.grad))
         except AttributeError:
-            return Subtraction(Constant(other), self, grad=self.grad)
+            return Subtraction.make(Constant(other), self, grad=self.grad)
 
     def __mul__(self, other):
         try:
-            return Multiplication(self, other, grad=(other.grad and self.grad))
+            return Multiplication.make(self, other, grad=(other.grad or self.grad))
         except AttributeError:
-            return Multiplication(self, Constant(other), grad=self.grad)
+            return Multiplication.make(self, Constant(other), grad=self.grad)
     
     def __rmul__(self, other):
         # TODO: Multiplication not commutative if we enable matrix support
@@ -64,15 +180,15 @@ class Expression(object):
     
     def __truediv__(self, other):
         try:
-            return Division(self, other, grad=(other.grad and self.grad))
+            return Division.make(self, other, grad=(other.grad or self.grad))
         except AttributeError:
-            return Division(self, Constant(other), grad=self.grad)
+            return Division.make(self, Constant(other), grad=self.grad)
 
     def __rtruediv__(self, other):
         try:
-            return Division(other, self, grad=(other.grad and self.grad))
+            return Division.make(other, self, grad=(other.grad or self.grad))
         except AttributeError:
-            return Division(Constant(other), self, grad=self.grad)
+            return Division.make(Constant(other), self, grad=self.grad)
 
     def sin(self):
         return Sin(self)
@@ -88,11 +204,14 @@ class Expression(object):
 
 
 class Variable(Expression):
+    __slots__ = ('name',)
+    _kind = VAR
+
     def __init__(self, name, grad=True):
-        self.grad = grad
+        super().__init__(grad=grad)
         self.name = name
     
-    def _eval(self, feed_dict, cache_dict):
+    def _lookup(self, feed_dict):
         # Check if the user specified either the object in feed_dict or
         # the name of the object in feed_dict
         if self in feed_dict:
@@ -101,27 +220,58 @@ class Variable(Expression):
             return feed_dict[self.name]
         else:
             raise ValueError('Unbound variable %s' % self.name)
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        return 1.0 
+
+    def _signature(self, args):
+        # Variables are fed by object, only the same object is the same value
+        return (VAR, id(self))
+
+    def _tangent(self, value):
+        # Keep the value's floating precision, e.g. float32 stays float32
+        if isinstance(value, (np.ndarray, np.generic)):
+            if value.dtype.kind == 'f':
+                return np.ones_like(value)[()]
+            return np.ones_like(value, dtype=float)[()]
+        return 1.0
+
+    def _partials(self, res):
+        return ()
 
 
 class Constant(Expression):
     '''Represents a constant.'''
+    __slots__ = ('val',)
+    _kind = CONST
+
     def __init__(self, val, grad=False):
         super().__init__(grad=grad)
         self.val = val
     
-    def _eval(self, feed_dict, cache_dict):
+    def _op(self):
         return self.val
 
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        return 0
+    def _signature(self, args):
+        # repr tells apart equal values that compute differently, e.g. 0.0
+        # and -0.0
+        key = (CONST, type(self.val), self.val, repr(self.val))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable values such as arrays are never merged
+            return (CONST, id(self))
+        return key
+
+    def _partials(self, res):
+        return ()
 
 
 class Unop(Expression):
     '''Utilities common to all unary operations in the form Op(a)'''
-    def __init__(self, expr1, grad=False):
+    __slots__ = ('expr1',)
+
+    def __init__(self, expr1, grad=None):
+        # By default an operation needs gradient if its operand does
+        if grad is None:
+            grad = expr1.grad
         super().__init__(grad=grad)
         self.expr1 = expr1
         self.children = [self.expr1]
@@ -129,140 +279,714 @@ class Unop(Expression):
 
 class Binop(Expression):
     '''Utilities common to all binary operations in the form Op(a, b)'''
-    def __init__(self, expr1, expr2, grad=False):
+    __slots__ = ('expr1', 'expr2')
+
+    def __init__(self, expr1, expr2, grad=None):
+        # By default an operation needs gradient if either operand does
+        if grad is None:
+            grad = expr1.grad or expr2.grad
         super().__init__(grad=grad)
         self.expr1 = expr1
         self.expr2 = expr2
         self.children = [self.expr1, self.expr2]
 
+    @classmethod
+    def make(cls, expr1, expr2, grad=None):
+        '''Builds cls(expr1, expr2), or a smaller equivalent expression when
+        constant operands already determine the result.'''
+        folded = cls._fold(expr1, expr2, _constant_value(expr1),
+                           _constant_value(expr2))
+        if folded is not None:
+            return folded
+        return cls(expr1, expr2, grad=grad)
+
+    @staticmethod
+    def _fold(expr1, expr2, c1, c2):
+        '''Helper - Returns the folded expression, or None if nothing folds.
+        @param: c1, c2: values of expr1 and expr2 when they are constants,
+        otherwise None
+        '''
+        return None
+
 
 class Addition(Binop):
     '''Addition, in the form A + B'''
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            res2 = self.expr2._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = res1 + res2
-        return cache_dict[id(self)]
-
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d2 = self.expr2._d(feed_dict, e_cache_dict, d_cache_dict)
-            d_cache_dict[id(self)] = d1 + d2
-        return d_cache_dict[id(self)]
-            
+    __slots__ = ()
+    _kind = ADD
+    _source = '{0} + {1}'
+    _d_source = '{d0} + {d1}'
+
+    @staticmethod
+    def _fold(expr1, expr2, c1, c2):
+        if c1 is not None and c2 is not None:
+            return Constant(c1 + c2)
+        if c1 == 0:
+            return expr2
+        if c2 == 0:
+            return expr1
+        return None
+
+    def _op(self, a, b):
+        return a + b
+
+    def _signature(self, args):
+        # Commutative, so the order of the operands doesn't matter
+        return (self._kind, self.grad, tuple(sorted(args)))
+
+    def _partials(self, res, a, b):
+        return 1.0, 1.0
+
 
 class Subtraction(Binop):
     '''Subtraction, in the form A - B'''
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            res2 = self.expr2._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = res1 - res2
-        return cache_dict[id(self)]
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d2 = self.expr2._d(feed_dict, e_cache_dict, d_cache_dict)
-            d_cache_dict[id(self)] = d1 - d2
-        return d_cache_dict[id(self)]
+    __slots__ = ()
+    _kind = SUB
+    _source = '{0} - {1}'
+    _d_source = '{d0} - {d1}'
+
+    @staticmethod
+    def _fold(expr1, expr2, c1, c2):
+        if c1 is not None and c2 is not None:
+            return Constant(c1 - c2)
+        if c2 == 0:
+            return expr1
+        return None
+
+    def _op(self, a, b):
+        return a - b
+
+    def _partials(self, res, a, b):
+        return 1.0, -1.0
 
 
 class Multiplication(Binop):
     '''Multiplication, in the form A * B'''
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            res2 = self.expr2._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = res1 * res2
-        return cache_dict[id(self)]
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d2 = self.expr2._d(feed_dict, e_cache_dict, d_cache_dict)
-            res1 = self.expr1._eval(feed_dict, e_cache_dict)
-            res2 = self.expr2._eval(feed_dict, e_cache_dict)
-            d_cache_dict[id(self)] = res1 * d2 + res2 * d1
-        return d_cache_dict[id(self)]
+    __slots__ = ()
+    _kind = MUL
+    _source = '{0} * {1}'
+    _d_source = '{0} * {d1} + {1} * {d0}'
+
+    @staticmethod
+    def _fold(expr1, expr2, c1, c2):
+        if c1 is not None and c2 is not None:
+            return Constant(c1 * c2)
+        if c1 == 0 or c2 == 0:
+            return Constant(0)
+        if c1 == 1:
+            return expr2
+        if c2 == 1:
+            return expr1
+        return None
+
+    def _op(self, a, b):
+        return a * b
+
+    def _signature(self, args):
+        # Commutative, so the order of the operands doesn't matter
+        return (self._kind, self.grad, tuple(sorted(args)))
+
+    def _partials(self, res, a, b):
+        return b, a
 
 
 class Division(Binop):
     '''Division, in the form A / B'''
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            res2 = self.expr2._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = res1 / res2
-        return cache_dict[id(self)]
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d2 = self.expr2._d(feed_dict, e_cache_dict, d_cache_dict)
-            res1 = self.expr1._eval(feed_dict, e_cache_dict)
-            res2 = self.expr2._eval(feed_dict, e_cache_dict)
-            d_cache_dict[id(self)] = (d1 / res2) - (d2 * res1 / (res2 * res2))
-        return d_cache_dict[id(self)]
+    __slots__ = ()
+    _kind = DIV
+    _source = '{0} / {1}'
+    _d_source = '{d0} / {1} - {d1} * {0} / ({1} * {1})'
+
+    @staticmethod
+    def _fold(expr1, expr2, c1, c2):
+        # Division by a constant zero is left for eval to report
+        if c1 is not None and c2 is not None and c2 != 0:
+            return Constant(c1 / c2)
+        if c2 == 1:
+            return expr1
+        return None
+
+    def _op(self, a, b):
+        return a / b
+
+    def _partials(self, res, a, b):
+        return 1.0 / b, -a / (b * b)
 
 
 class Sin(Unop):
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = np.sin(res1)
-        return cache_dict[id(self)]
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            res1 = self.expr1._eval(feed_dict, e_cache_dict)
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d_cache_dict[id(self)] = np.cos(res1) * d1 
-        return d_cache_dict[id(self)]
+    __slots__ = ()
+    _kind = SIN
+    _source = 'np.sin({0})'
+    _d_source = 'np.cos({0}) * {d0}'
+
+    def _op(self, a):
+        return np.sin(a)
+
+    def _partials(self, res, a):
+        return (np.cos(a),)
 
 
 class Cos(Unop):
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = np.cos(res1)
-        return cache_dict[id(self)]
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            res1 = self.expr1._eval(feed_dict, e_cache_dict)
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d_cache_dict[id(self)] = -np.sin(res1) * d1 
-        return d_cache_dict[id(self)]
+    __slots__ = ()
+    _kind = COS
+    _source = 'np.cos({0})'
+    _d_source = '-np.sin({0}) * {d0}'
+
+    def _op(self, a):
+        return np.cos(a)
+
+    def _partials(self, res, a):
+        return (-np.sin(a),)
 
 
 class Exp(Unop):
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = np.exp(res1)
-        return cache_dict[id(self)]
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            res1 = self.expr1._eval(feed_dict, e_cache_dict)
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d_cache_dict[id(self)] = np.exp(res1) * d1 
-        return d_cache_dict[id(self)]
+    __slots__ = ()
+    _kind = EXP
+    _source = 'np.exp({0})'
+    _d_source = '{res} * {d0}'
+
+    def _op(self, a):
+        return np.exp(a)
+
+    def _partials(self, res, a):
+        return (res,)
 
 
 class Log(Unop):
-    def _eval(self, feed_dict, cache_dict):
-        if id(self) not in cache_dict:
-            res1 = self.expr1._eval(feed_dict, cache_dict)
-            cache_dict[id(self)] = np.log(res1)
-        return cache_dict[id(self)]
-    
-    def _d(self, feed_dict, e_cache_dict, d_cache_dict):
-        if id(self) not in d_cache_dict:
-            res1 = self.expr1._eval(feed_dict, e_cache_dict)
-            d1 = self.expr1._d(feed_dict, e_cache_dict, d_cache_dict)
-            d_cache_dict[id(self)] = d1 / res1 
-        return d_cache_dict[id(self)]
+    __slots__ = ()
+    _kind = LOG
+    _source = 'np.log({0})'
+    _d_source = '{d0} / {0}'
+
+    def _op(self, a):
+        return np.log(a)
+
+    def _partials(self, res, a):
+        return (1.0 / a,)
+
+
+class CompiledGraph(object):
+    '''The computation graph of one expression, numbered once in
+    topological order.
+
+    tape holds (node, child indices) pairs where every child index points to
+    an earlier entry and the last entry is the root. The same graph is also
+    kept as parallel arrays, one slot per tape entry: op_kind (operation
+    code), lhs and rhs (child positions, -1 when absent; for VAR, lhs is the
+    variable's position in variables) and const_val (value of CONST
+    entries). Scalar evaluations run on the arrays through the Numba
+    kernels; anything else, e.g. NumPy array feeds, walks the tape.'''
+    def __init__(self, root):
+        # Nodes computing the same thing share one tape entry
+        index = dict()
+        seen = dict()
+        self.tape = []
+        for node in root._topo_order():
+            args = [index[id(child)] for child in node.children]
+            key = node._signature(args)
+            if key not in seen:
+                seen[key] = len(self.tape)
+                self.tape.append((node, args))
+            index[id(node)] = seen[key]
+        n = len(self.tape)
+        self.op_kind = np.empty(n, dtype=np.int8)
+        self.lhs = np.full(n, -1, dtype=np.int32)
+        self.rhs = np.full(n, -1, dtype=np.int32)
+        self.const_val = np.zeros(n, dtype=np.float64)
+        self.needs_grad = np.zeros(n, dtype=np.bool_)
+        # Variables and their tape positions, in the same order
+        self.variables = []
+        self.var_pos = []
+        # Every other entry, computed from its children by _op
+        self.op_entries = []
+        # Scalar kernel buffers, see _scratch
+        self._local = threading.local()
+        # Generated evaluate and derivative functions, see _generated
+        self._functions = None
+        # The kernels only understand float constants, and ints they can
+        # convert exactly
+        self.use_kernels = _HAVE_NUMBA
+        # Entries computed from int constants alone, which Python keeps exact
+        int_valued = set()
+        for k, (node, args) in enumerate(self.tape):
+            self.op_kind[k] = node._kind
+            self.needs_grad[k] = node.grad
+            if node._kind == VAR:
+                self.lhs[k] = len(self.variables)
+                self.variables.append(node)
+                self.var_pos.append(k)
+                continue
+            self.op_entries.append((k, node, args))
+            if node._kind == CONST:
+                if isinstance(node.val, float):
+                    self.const_val[k] = node.val
+                elif (isinstance(node.val, numbers.Integral)
+                      and abs(node.val) <= 2 ** 53):
+                    self.const_val[k] = node.val
+                    int_valued.add(k)
+                else:
+                    self.use_kernels = False
+            elif args and all(i in int_valued for i in args):
+                int_valued.add(k)
+                # The kernels would compute it in float
+                self.use_kernels = False
+            if len(args) > 0:
+                self.lhs[k] = args[0]
+            if len(args) > 1:
+                self.rhs[k] = args[1]
+        # An int constant on its own would come back as float too
+        if n - 1 in int_valued:
+            self.use_kernels = False
+        # Direction the kernels differentiate along, one entry per variable
+        self.tangents = np.array([1.0 if var.grad else 0.0
+                                  for var in self.variables])
+
+    def eval(self, feed_dict):
+        '''Evaluates the graph given a dictionary of variables mapped to
+        values.'''
+        values = self._feed(feed_dict)
+        var_values, shape = self._kernel_feed(values)
+        if var_values is None:
+            return self._generated()[0](*values)
+        if shape is None:
+            out, _, _ = self._scratch()
+            res, zero_divisor = eval_tape(self.op_kind, self.lhs, self.rhs,
+                                          self.const_val, var_values, out)
+            if zero_divisor:
+                return self._generated()[0](*values)
+            return res
+        out = np.empty((var_values.shape[0], len(self.tape)))
+        eval_batch(self.op_kind, self.lhs, self.rhs, self.const_val,
+                   var_values, out)
+        return out[:, -1].reshape(shape).copy()
+
+    def d(self, feed_dict):
+        '''Evaluates the derivative at the points given, carrying the value
+        and the derivative of every entry forward together (dual numbers).'''
+        values = self._feed(feed_dict)
+        var_values, shape = self._kernel_feed(values)
+        if var_values is not None:
+            if shape is not None:
+                out = np.empty((var_values.shape[0], len(self.tape)))
+                d_out = np.empty((var_values.shape[0], len(self.tape)))
+                dual_batch(self.op_kind, self.lhs, self.rhs, self.const_val,
+                           self.needs_grad, var_values, self.tangents, out,
+                           d_out)
+                return d_out[:, -1].reshape(shape).copy()
+            out, d_out, _ = self._scratch()
+            res, zero_divisor = dual_tape(
+                self.op_kind, self.lhs, self.rhs, self.const_val,
+                self.needs_grad, var_values, self.tangents, out, d_out)
+            if not zero_divisor:
+                return res
+        tangents = [var._tangent(value) if var.grad else 0
+                    for var, value in zip(self.variables, values)]
+        return self._broadcast(self._generated()[1](*(values + tangents)),
+                               values)
+
+    def backward(self, feed_dict, checkpoint_every=None):
+        '''Evaluates the gradient with respect to every variable in a single
+        reverse sweep, returns a dictionary mapping each Variable that needs
+        gradient to its partial derivative. See Expression.backward for
+        checkpoint_every.'''
+        values = self._feed(feed_dict)
+        if checkpoint_every is not None:
+            return self._backward_checkpointed(self._numpy_scalars(values),
+                                               checkpoint_every)
+        var_values, shape = self._kernel_feed(values)
+        if shape is not None:
+            var_grad = self._grad_batch(var_values)
+            return {var: var_grad[:, k].reshape(shape).copy()
+                    for k, var in enumerate(self.variables) if var.grad}
+        if var_values is not None:
+            out, adjoint, var_grad = self._scratch()
+            _, zero_divisor = eval_tape(self.op_kind, self.lhs, self.rhs,
+                                        self.const_val, var_values, out)
+            zero_partial = grad_tape(self.op_kind, self.lhs, self.rhs,
+                                     self.needs_grad, out, adjoint, var_grad)
+            if not (zero_divisor or zero_partial):
+                return {var: var_grad[k]
+                        for k, var in enumerate(self.variables) if var.grad}
+        values = self._numpy_scalars(values)
+        cache = self._eval_tape(values)
+        adjoints = [0.0] * len(self.tape)
+        adjoints[-1] = 1.0
+        # Every node must have its adjoint fully accumulated before it is
+        # propagated, so walk the tape parents-first
+        for k in reversed(range(len(self.tape))):
+            node, args = self.tape[k]
+            if not node.grad:
+                continue
+            partials = node._partials(cache[k], *[cache[i] for i in args])
+            for i, partial in zip(args, partials):
+                adjoints[i] = adjoints[i] + adjoints[k] * partial
+        return {node: self._broadcast(adjoints[k], values)
+                for k, (node, _) in enumerate(self.tape)
+                if isinstance(node, Variable) and node.grad}
+
+    def _backward_checkpointed(self, values, checkpoint_every):
+        '''Helper - Reverse sweep keeping only the values at tape positions
+        0, k, 2k, ... (k = checkpoint_every) and the root. The tape is swept
+        back one segment of k entries at a time, recomputing the values the
+        segment needs from the checkpoints and dropping them afterwards.'''
+        if checkpoint_every < 1:
+            raise ValueError('checkpoint_every must be at least 1')
+        n = len(self.tape)
+        # Variables are already at hand, keep them with the checkpoints
+        stored = dict(zip(self.var_pos, values))
+        for k in list(range(0, n, checkpoint_every)) + [n - 1]:
+            stored[k] = self._rematerialize(k, stored, dict())
+        adjoints = {n - 1: 1.0}
+        grads = dict()
+        for start in reversed(range(0, n, checkpoint_every)):
+            segment = dict()
+            for k in reversed(range(start, min(start + checkpoint_every, n))):
+                node, args = self.tape[k]
+                # Adjoints are complete once the sweep reaches them, and
+                # nothing refers back to them afterwards
+                adjoint = adjoints.pop(k, 0.0)
+                if not node.grad:
+                    continue
+                if isinstance(node, Variable):
+                    grads[node] = adjoint
+                    continue
+                child_values = [self._rematerialize(i, stored, segment)
+                                for i in args]
+                res = self._rematerialize(k, stored, segment)
+                partials = node._partials(res, *child_values)
+                for i, partial in zip(args, partials):
+                    adjoints[i] = adjoints.get(i, 0.0) + adjoint * partial
+        return {var: self._broadcast(grads.get(var, 0.0), values)
+                for var in self.variables if var.grad}
+
+    def _rematerialize(self, k, stored, segment):
+        '''Helper - Returns the value of tape entry k, recomputing it from
+        the checkpoints in stored when needed. Recomputed values are kept in
+        segment.'''
+        stack = [k]
+        while stack:
+            j = stack[-1]
+            if j in stored or j in segment:
+                stack.pop()
+                continue
+            node, args = self.tape[j]
+            missing = [i for i in args if i not in stored and i not in segment]
+            if missing:
+                stack.extend(missing)
+                continue
+            segment[j] = node._op(*[
+                stored[i] if i in stored else segment[i] for i in args])
+            stack.pop()
+        return stored[k] if k in stored else segment[k]
+
+    def _eval_tape(self, values):
+        '''Helper - Evaluates every entry of the tape in order given the
+        variable values, returns the list of values indexed like the tape.'''
+        cache = [None] * len(self.tape)
+        for k, value in zip(self.var_pos, values):
+            cache[k] = value
+        for k, node, args in self.op_entries:
+            cache[k] = node._op(*[cache[i] for i in args])
+        return cache
+
+    def _generated(self):
+        '''Helper - Returns (evaluate, derivative): straight-line Python
+        functions for this graph, generated from the tape on first use.
+        evaluate(v0, v1, ...) takes the variable values in the order of
+        self.variables and returns the value; derivative(v0, ..., g0, ...)
+        also takes the tangent of every variable and returns the derivative
+        along them. Values may be anything NumPy broadcasts over.'''
+        if self._functions is not None:
+            return self._functions
+        namespace = {'np': np}
+        lines = []
+        d_lines = []
+        # Derivative expression of every entry, '0' where it is known zero
+        d_names = dict()
+        for slot, (var, k) in enumerate(zip(self.variables, self.var_pos)):
+            lines.append('t%d = v%d' % (k, slot))
+            d_lines.append(lines[-1])
+            d_names[k] = 'g%d' % slot if var.grad else '0'
+        for k, node, args in self.op_entries:
+            if node._kind == CONST:
+                namespace['c%d' % k] = node.val
+                lines.append('t%d = c%d' % (k, k))
+            else:
+                names = ['t%d' % i for i in args]
+                lines.append('t%d = %s' % (k, node._source.format(*names)))
+            d_lines.append(lines[-1])
+            d_args = [d_names[i] for i in args]
+            if not node.grad or all(d == '0' for d in d_args):
+                d_names[k] = '0'
+                continue
+            d_source = node._d_source.format(
+                *names, res='t%d' % k,
+                **{'d%d' % j: d for j, d in enumerate(d_args)})
+            d_lines.append('d%d = %s' % (k, d_source))
+            d_names[k] = 'd%d' % k
+        params = ['v%d' % slot for slot in range(len(self.variables))]
+        d_params = params + ['g%d' % slot for slot in range(len(params))]
+        last = len(self.tape) - 1
+        source = '\n'.join(
+            ['def evaluate(%s):' % ', '.join(params)]
+            + ['    ' + line for line in lines]
+            + ['    return t%d' % last]
+            + ['def derivative(%s):' % ', '.join(d_params)]
+            + ['    ' + line for line in d_lines]
+            + ['    return %s' % (d_names[last] if d_names[last] != '0'
+                              else '0.0')]) + '\n'
+        exec(compile(source, '<compiled graph>', 'exec'), namespace)
+        self._functions = namespace['evaluate'], namespace['derivative']
+        return self._functions
+
+    def _broadcast(self, result, values):
+        '''Helper - Returns result broadcast against the variable values when
+        some of them are NumPy arrays, so a partial or derivative that doesn't
+        depend on them still has their shape, as on the batch kernel path.'''
+        if not any(isinstance(value, np.ndarray) for value in values):
+            return result
+        shape = np.broadcast_shapes(np.shape(result),
+                                    *[np.shape(value) for value in values])
+        if np.shape(result) != shape:
+            result = np.broadcast_to(result, shape).copy()
+        return result
+
+    def _numpy_scalars(self, values):
+        '''Helper - When some of values are NumPy arrays, returns them with
+        the Python int and float scalars turned into NumPy int64/float64
+        scalars, so that partials such as 1.0 / b give inf/nan like the batch
+        kernels rather than raise ZeroDivisionError. Otherwise returns values
+        as they are.'''
+        if not any(isinstance(value, np.ndarray) for value in values):
+            return values
+        return [np.asarray(value)[()]
+                if isinstance(value, (int, float))
+                and not isinstance(value, np.generic) else value
+                for value in values]
+
+    def _scratch(self):
+        '''Helper - Returns this thread's float64 buffers for the scalar
+        kernels: two of the tape's length and one per variable. They are
+        allocated on first use and overwritten by every later call, so
+        nothing holding a reference to them may be returned.'''
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            n = len(self.tape)
+            buffers = (np.empty(n), np.empty(n),
+                       np.empty(len(self.variables)))
+            self._local.buffers = buffers
+        return buffers
+
+    def _feed(self, feed_dict):
+        '''Helper - Looks every variable up in feed_dict once, returns their
+        values in the order of self.variables.'''
+        return [var._lookup(feed_dict) for var in self.variables]
+
+    def _grad_batch(self, var_values):
+        '''Helper - Runs grad_batch over samples laid out as returned by
+        _kernel_feed, returns the (samples, variables) array of partials.'''
+        samples, n = var_values.shape[0], len(self.tape)
+        out = np.empty((samples, n))
+        adjoint = np.empty((samples, n))
+        var_grad = np.empty((samples, len(self.variables)))
+        grad_batch(self.op_kind, self.lhs, self.rhs, self.const_val,
+                   self.needs_grad, var_values, out, adjoint, var_grad)
+        return var_grad
+
+    def _kernel_feed(self, values):
+        '''Helper - Lays out the variable values for the kernels. Returns
+        (var_values, shape): a float64 array in the order of self.variables
+        and None when every value is a float scalar, or a (samples, variables)
+        array and the broadcast shape of the values when some are NumPy
+        arrays and enough threads are available. Returns (None, None) when
+        the feed should stay on the NumPy path.'''
+        if not self.use_kernels:
+            return None, None
+        for value in values:
+            # Other dtypes (e.g. int, float32, complex) keep the NumPy path
+            # so the result has the same dtype it would have there
+            if isinstance(value, np.ndarray):
+                if value.dtype != np.float64:
+                    return None, None
+            # So do ints, Fractions and other non-float scalars, whose
+            # arithmetic Python keeps exact
+            elif not isinstance(value, float):
+                return None, None
+        if not any(isinstance(value, np.ndarray) for value in values):
+            return np.array(values, dtype=np.float64), None
+        if get_num_threads() < BATCH_MIN_THREADS:
+            return None, None
+        arrays = np.broadcast_arrays(*values)
+        var_values = np.empty((arrays[0].size, len(arrays)))
+        for k, array in enumerate(arrays):
+            var_values[:, k] = array.ravel()
+        return var_values, arrays[0].shape
+
+
+# error_model='numpy' makes division by zero give inf/nan inside the kernels
+# rather than raise. Python floats raise ZeroDivisionError on the NumPy path,
+# so the scalar kernels also report whether they divided by zero and the
+# callers rerun such calls there; array feeds give inf/nan on both paths.
+@njit(cache=True, error_model='numpy')
+def eval_tape(op_kind, lhs, rhs, const_val, var_values, out):
+    '''Evaluates a graph stored as the arrays of a CompiledGraph, with
+    var_values holding one value per variable. Fills out with the value of
+    every tape entry and returns the value of the last one, and whether a
+    Division divided by zero.'''
+    zero_divisor = False
+    for i in range(op_kind.shape[0]):
+        kind = op_kind[i]
+        if kind == ADD:
+            out[i] = out[lhs[i]] + out[rhs[i]]
+        elif kind == SUB:
+            out[i] = out[lhs[i]] - out[rhs[i]]
+        elif kind == MUL:
+            out[i] = out[lhs[i]] * out[rhs[i]]
+        elif kind == DIV:
+            b = out[rhs[i]]
+            if b == 0.0:
+                zero_divisor = True
+            out[i] = out[lhs[i]] / b
+        elif kind == VAR:
+            out[i] = var_values[lhs[i]]
+        elif kind == CONST:
+            out[i] = const_val[i]
+        elif kind == SIN:
+            out[i] = np.sin(out[lhs[i]])
+        elif kind == COS:
+            out[i] = np.cos(out[lhs[i]])
+        elif kind == EXP:
+            out[i] = np.exp(out[lhs[i]])
+        elif kind == LOG:
+            out[i] = np.log(out[lhs[i]])
+    return out[op_kind.shape[0] - 1], zero_divisor
+
+
+@njit(cache=True, error_model='numpy')
+def grad_tape(op_kind, lhs, rhs, needs_grad, out, adjoint, var_grad):
+    '''Reverse sweep over a graph stored as the arrays of a CompiledGraph,
+    where out holds the values filled by eval_tape. Entries whose
+    needs_grad is False are not propagated through.
+    Accumulates the adjoint of every tape entry in adjoint and stores the
+    partial derivative with respect to each variable in var_grad. Returns
+    whether a partial divided by zero.'''
+    zero_divisor = False
+    n = op_kind.shape[0]
+    adjoint[:] = 0.0
+    var_grad[:] = 0.0
+    adjoint[n - 1] = 1.0
+    for i in range(n - 1, -1, -1):
+        if not needs_grad[i]:
+            continue
+        kind = op_kind[i]
+        adj = adjoint[i]
+        if kind == ADD:
+            adjoint[lhs[i]] += adj
+            adjoint[rhs[i]] += adj
+        elif kind == SUB:
+            adjoint[lhs[i]] += adj
+            adjoint[rhs[i]] -= adj
+        elif kind == MUL:
+            adjoint[lhs[i]] += adj * out[rhs[i]]
+            adjoint[rhs[i]] += adj * out[lhs[i]]
+        elif kind == DIV:
+            b = out[rhs[i]]
+            if b * b == 0.0:
+                zero_divisor = True
+            adjoint[lhs[i]] += adj / b
+            adjoint[rhs[i]] -= adj * out[lhs[i]] / (b * b)
+        elif kind == VAR:
+            var_grad[lhs[i]] += adj
+        elif kind == SIN:
+            adjoint[lhs[i]] += adj * np.cos(out[lhs[i]])
+        elif kind == COS:
+            adjoint[lhs[i]] -= adj * np.sin(out[lhs[i]])
+        elif kind == EXP:
+            adjoint[lhs[i]] += adj * out[i]
+        elif kind == LOG:
+            if out[lhs[i]] == 0.0:
+                zero_divisor = True
+            adjoint[lhs[i]] += adj / out[lhs[i]]
+    return zero_divisor
+
+
+@njit(cache=True, error_model='numpy')
+def dual_tape(op_kind, lhs, rhs, const_val, needs_grad, var_values,
+              var_tangent, out, d_out):
+    '''Forward-mode sweep over a graph stored as the arrays of a
+    CompiledGraph: fills out with the value and d_out with the derivative of
+    every tape entry along var_tangent (one direction component per
+    variable). Returns the derivative of the last one, and whether the value
+    or the derivative divided by zero.'''
+    zero_divisor = False
+    for i in range(op_kind.shape[0]):
+        kind = op_kind[i]
+        l = lhs[i]
+        r = rhs[i]
+        if kind == ADD:
+            out[i] = out[l] + out[r]
+            d_out[i] = d_out[l] + d_out[r]
+        elif kind == SUB:
+            out[i] = out[l] - out[r]
+            d_out[i] = d_out[l] - d_out[r]
+        elif kind == MUL:
+            out[i] = out[l] * out[r]
+            d_out[i] = out[l] * d_out[r] + out[r] * d_out[l]
+        elif kind == DIV:
+            if out[r] * out[r] == 0.0:
+                zero_divisor = True
+            out[i] = out[l] / out[r]
+            d_out[i] = (d_out[l] / out[r]
+                        - d_out[r] * out[l] / (out[r] * out[r]))
+        elif kind == VAR:
+            out[i] = var_values[l]
+            d_out[i] = var_tangent[l]
+        elif kind == CONST:
+            out[i] = const_val[i]
+            d_out[i] = 0.0
+        elif kind == SIN:
+            out[i] = np.sin(out[l])
+            d_out[i] = np.cos(out[l]) * d_out[l]
+        elif kind == COS:
+            out[i] = np.cos(out[l])
+            d_out[i] = -np.sin(out[l]) * d_out[l]
+        elif kind == EXP:
+            out[i] = np.exp(out[l])
+            d_out[i] = out[i] * d_out[l]
+        elif kind == LOG:
+            if out[l] == 0.0:
+                zero_divisor = True
+            out[i] = np.log(out[l])
+            d_out[i] = d_out[l] / out[l]
+        # Nothing below this entry needs gradient
+        if not needs_grad[i]:
+            d_out[i] = 0.0
+    return d_out[op_kind.shape[0] - 1], zero_divisor
+
+
+@njit(cache=True, error_model='numpy', parallel=True)
+def eval_batch(op_kind, lhs, rhs, const_val, var_values, out):
+    '''Runs eval_tape on every sample in parallel, with var_values[s] the
+    variable values of sample s and out[s] receiving its tape values.'''
+    for s in prange(var_values.shape[0]):
+        eval_tape(op_kind, lhs, rhs, const_val, var_values[s], out[s])
+
+
+@njit(cache=True, error_model='numpy', parallel=True)
+def grad_batch(op_kind, lhs, rhs, const_val, needs_grad, var_values, out,
+               adjoint, var_grad):
+    '''Runs eval_tape then grad_tape on every sample in parallel, laid out
+    like eval_batch, with var_grad[s] receiving the partials of sample s.'''
+    for s in prange(var_values.shape[0]):
+        eval_tape(op_kind, lhs, rhs, const_val, var_values[s], out[s])
+        grad_tape(op_kind, lhs, rhs, needs_grad, out[s], adjoint[s],
+                  var_grad[s])
+
+
+@njit(cache=True, error_model='numpy', parallel=True)
+def dual_batch(op_kind, lhs, rhs, const_val, needs_grad, var_values,
+               var_tangent, out, d_out):
+    '''Runs dual_tape on every sample in parallel, laid out like
+    eval_batch, with d_out[s] receiving the derivatives of sample s.'''
+    for s in prange(var_values.shape[0]):
+        dual_tape(op_kind, lhs, rhs, const_val, needs_grad, var_values[s],
+                  var_tangent, out[s], d_out[s])
@@ -0,0 +1,53 @@
+'''Testing suite for the forward-mode derivative computed by d().'''
+import unittest
+import numpy as np
+import ad
+
+
+class TestDerivative(unittest.TestCase):
+
+    def test_scalar(self):
+        x = ad.Variable('x')
+        y = x.sin().exp()
+        self.assertAlmostEqual(y.d({x: 1.5}), np.cos(1.5) * np.exp(np.sin(1.5)))
+
+    def test_array_feed(self):
+        x = ad.Variable('x')
+        y = (5 / x).exp() - 5
+        samples = np.linspace(1, 3, 11)
+        np.testing.assert_allclose(y.d({x: samples}),
+                                   -5 / samples ** 2 * np.exp(5 / samples))
+
+    def test_array_feed_identity(self):
+        x = ad.Variable('x')
+        samples = np.linspace(0, 1, 5)
+        np.testing.assert_array_equal(x.d({x: samples}), np.ones(5))
+
+    def test_float32_preserved(self):
+        x = ad.Variable('x')
+        y = x.sin() * x + 2.0 / x
+        samples = np.linspace(1, 2, 5, dtype=np.float32)
+        self.assertEqual(y.eval({x: samples}).dtype, np.float32)
+        self.assertEqual(y.d({x: samples}).dtype, np.float32)
+        self.assertEqual(x.d({x: np.float32(1.0)}).dtype, np.float32)
+
+    def test_deep_graph(self):
+        # Deeper than the default recursion limit
+        x = ad.Variable('x')
+        y = x
+        for _ in range(5000):
+            y = (y * 1.0001).sin()
+        self.assertTrue(np.isfinite(y.eval({x: 0.5})))
+        self.assertTrue(np.isfinite(y.d({x: 0.5})))
+
+    def test_several_variables(self):
+        # d() differentiates along every variable at once
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        y = x1 * x2 + x1.cos() / x2
+        feed = {x1: 0.5, x2: 2.0}
+        self.assertAlmostEqual(y.d(feed), sum(y.backward(feed).values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
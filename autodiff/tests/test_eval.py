@@ -1,6 +1,9 @@
 '''Testing suite for testing only the evaluation part of the script, with no
 automatic differentiation.'''
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import numpy as np
 import ad
 
 class TestAddition(unittest.TestCase):
@@ -27,5 +30,195 @@ class TestSubtraction(unittest.TestCase):
         self.assertEqual((1 - c1).eval({}), 0)
         self.assertEqual(((-5) - c1).eval({}), -6.0)
 
+
+class TestConstantFolding(unittest.TestCase):
+
+    def test_constants_fold(self):
+        y = ad.Constant(2.0) * 3 + ad.Constant(1.0) / 4
+        self.assertIsInstance(y, ad.Constant)
+        self.assertEqual(y.eval({}), 6.25)
+
+    def test_identities_fold(self):
+        x = ad.Variable('x')
+        self.assertIs(x + 0, x)
+        self.assertIs(0 + x, x)
+        self.assertIs(x - 0, x)
+        self.assertIs(x * 1, x)
+        self.assertIs(x / 1, x)
+        self.assertEqual((x * 0).eval({}), 0)
+
+    def test_division_by_zero_not_folded(self):
+        y = ad.Constant(1.0) / 0
+        self.assertIsInstance(y, ad.Division)
+        with self.assertRaises(ZeroDivisionError):
+            y.eval({})
+
+    def test_division_by_zero_raises(self):
+        x = ad.Variable('x')
+        for y in [1 / x, x.log() * 2.0]:
+            with np.errstate(divide='ignore'):
+                with self.assertRaises(ZeroDivisionError):
+                    y.d({x: 0.0})
+                with self.assertRaises(ZeroDivisionError):
+                    y.backward({x: 0.0})
+        with self.assertRaises(ZeroDivisionError):
+            (1 / x).eval({x: 0.0})
+        # The derivative divides by the square of the divisor
+        with self.assertRaises(ZeroDivisionError):
+            (1 / x).d({x: 1e-200})
+
+
+class TestCompile(unittest.TestCase):
+
+    def test_shared_nodes_numbered_once(self):
+        x = ad.Variable('x')
+        s = x.sin()
+        y = s * s + x
+        self.assertIs(y.compile(), y.compile())
+        tape = y.compile().tape
+        self.assertEqual(len(tape), 4)
+        self.assertIs(tape[-1][0], y)
+        for k, (node, args) in enumerate(tape):
+            self.assertTrue(all(i < k for i in args))
+
+    def test_common_subexpressions_merged(self):
+        x = ad.Variable('x')
+        y = x.sin() + x.sin() * 2 + 2 * x.sin()
+        # x, sin(x), 2, sin(x) * 2, the two additions
+        self.assertEqual(len(y.compile().tape), 6)
+        self.assertAlmostEqual(y.eval({x: 0.5}), 5 * np.sin(0.5))
+        self.assertAlmostEqual(y.d({x: 0.5}), 5 * np.cos(0.5))
+
+    def test_signed_zeros_not_merged(self):
+        x = ad.Variable('x')
+        pos = ad.Constant(np.float64(0.0))
+        neg = ad.Constant(np.float64(-0.0))
+        y = (1.0 / pos + 1.0 / neg) + x * 0.5
+        # 1.0 is shared by both divisions, the zeros are not
+        self.assertEqual(len(y.compile().tape), 10)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.assertTrue(np.isnan(y.eval({x: 1.0})))
+
+    def test_kernel_matches_eval(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        y = (x1 * x2).sin() + (5 / x2).exp() - x1.log() + 2
+        graph = y.compile()
+        self.assertEqual(graph.variables, [x1, x2])
+        out = np.empty(len(graph.tape))
+        res, _ = ad.eval_tape(graph.op_kind, graph.lhs, graph.rhs,
+                              graph.const_val, np.array([1.5, 2.0]), out)
+        self.assertAlmostEqual(res, y.eval({x1: 1.5, x2: 2.0}))
+
+    def test_batch_kernel_matches_eval(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        y = (x1 * x2).sin() + (5 / x2).exp() - x1.log() + 2
+        graph = y.compile()
+        samples = np.linspace(1, 3, 11)
+        var_values = np.stack([samples, samples[::-1]], axis=1)
+        out = np.empty((len(samples), len(graph.tape)))
+        ad.eval_batch(graph.op_kind, graph.lhs, graph.rhs, graph.const_val,
+                      var_values, out)
+        np.testing.assert_allclose(
+            out[:, -1], y.eval({x1: samples, x2: samples[::-1]}))
+
+    def test_exact_scalars_not_cast(self):
+        x = ad.Variable('x')
+        self.assertIs(type(x.eval({x: 3})), int)
+        self.assertEqual((x * 2 + 1).eval({x: 2 ** 60}), 2 ** 61 + 1)
+        self.assertEqual((x * 3).eval({x: Fraction(1, 3)}), Fraction(1))
+
+    def test_array_constant(self):
+        x = ad.Variable('x')
+        y = x * ad.Constant(np.array([1.0, 2.0])) + 1
+        np.testing.assert_allclose(y.eval({x: 3.0}), [4.0, 7.0])
+        np.testing.assert_allclose(y.d({x: 3.0}), [1.0, 2.0])
+
+
+class TestRepeatedEval(unittest.TestCase):
+
+    def test_repeated_and_concurrent_calls(self):
+        x = ad.Variable('x')
+        y = (5 / x).exp() - 5
+        points = np.linspace(1, 3, 200)
+        expected = [np.exp(5 / p) - 5 for p in points]
+        np.testing.assert_allclose([y.eval({x: p}) for p in points], expected)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda p: y.eval({x: p}), points))
+        np.testing.assert_allclose(results, expected)
+
+
+class TestSlots(unittest.TestCase):
+
+    def test_nodes_have_no_dict(self):
+        x = ad.Variable('x')
+        for node in [x, ad.Constant(2.0), x.sin(), x + x, x * 3.0]:
+            self.assertFalse(hasattr(node, '__dict__'))
+
+
+class TestArrayFeed(unittest.TestCase):
+
+    def test_broadcast_samples(self):
+        x = ad.Variable('x')
+        y = (5 / x).exp() - 5
+        samples = np.linspace(1, 3, 11)
+        np.testing.assert_allclose(y.eval({x: samples}),
+                                   np.exp(5 / samples) - 5)
+
+    def test_eval_batch_shape(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        samples = np.linspace(0, 1, 6).reshape(2, 3)
+        y = x1 * x2 + 1
+        np.testing.assert_allclose(y.eval_batch({x1: samples, x2: 2.0}),
+                                   samples * 2 + 1)
+        np.testing.assert_allclose(y.d_batch({x1: samples, x2: 2.0}),
+                                   samples + 2)
+        # Results that don't depend on the samples are still one per sample
+        constant = x1 * 0 + 3
+        np.testing.assert_array_equal(constant.eval_batch({x1: samples}),
+                                      np.full((2, 3), 3))
+        np.testing.assert_array_equal(constant.d_batch({x1: samples}),
+                                      np.zeros((2, 3)))
+
+    def test_eval_batch_returns_new_array(self):
+        x = ad.Variable('x')
+        samples = np.linspace(0, 1, 5)
+        for y in [x, x + 0, x * 1.0]:
+            res = y.eval_batch({x: samples})
+            self.assertFalse(np.shares_memory(res, samples))
+            np.testing.assert_array_equal(res, samples)
+        # Values of variables the graph doesn't use don't take part
+        unused = ad.Variable('unused')
+        np.testing.assert_array_equal(
+            (x * 2.0).eval_batch({x: samples, unused: np.arange(3)}),
+            samples * 2.0)
+
+    def test_batch_kernels_match_numpy_path(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        xi = ad.Variable('xi')
+        cases = [(x1 * x2.sin(), {x1: np.linspace(0.5, 2, 7), x2: 2.0}),
+                 (xi * xi, {xi: np.arange(4)}),
+                 (x1 / x2, {x1: np.linspace(1, 2, 3), x2: 0.0})]
+        self.addCleanup(setattr, ad, 'BATCH_MIN_THREADS', ad.BATCH_MIN_THREADS)
+        for y, feed in cases:
+            results = []
+            # Keep array feeds on the NumPy path, then send them to the
+            # batch kernels whatever the thread count
+            for min_threads in [10 ** 6, 1]:
+                ad.BATCH_MIN_THREADS = min_threads
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    grads = y.backward(feed)
+                    results.append([y.eval(feed), y.d(feed)]
+                                   + [grads[var] for var in feed])
+            for numpy_res, kernel_res in zip(*results):
+                self.assertEqual(np.shape(numpy_res), np.shape(kernel_res))
+                self.assertEqual(np.result_type(numpy_res),
+                                 np.result_type(kernel_res))
+                np.testing.assert_allclose(numpy_res, kernel_res)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
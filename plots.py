@@ -5,8 +5,8 @@ import ad
 
 def plot_function(y, x, start_val, end_val, description):
     plot_x = np.linspace(start_val, end_val, 1001)
-    plot_y = [y.eval({x: v}) for v in plot_x]
-    plot_yd = [y.d({x: v}) for v in plot_x]
+    plot_y = y.eval_batch({x: plot_x})
+    plot_yd = y.d_batch({x: plot_x})
     plt.plot(plot_x, plot_y)
     plt.plot(plot_x, plot_yd)
     plt.title(description)
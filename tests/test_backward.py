@@ -0,0 +1,91 @@
+'''Testing suite for the reverse-mode gradient computed by backward().'''
+import unittest
+import numpy as np
+import ad
+
+
+class TestBackward(unittest.TestCase):
+
+    def test_single_variable(self):
+        x = ad.Variable('x')
+        y = x.sin() * x
+        grad = y.backward({x: 2.0})
+        self.assertAlmostEqual(grad[x], np.cos(2.0) * 2.0 + np.sin(2.0))
+
+    def test_multiple_variables(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        y = x1 * x2 - x1 / x2 + 3
+        grad = y.backward({x1: 3.0, x2: 2.0})
+        self.assertAlmostEqual(grad[x1], 2.0 - 1 / 2.0)
+        self.assertAlmostEqual(grad[x2], 3.0 + 3.0 / 4.0)
+
+    def test_shared_subexpression(self):
+        x = ad.Variable('x')
+        s = x.exp()
+        y = s * s + s
+        grad = y.backward({x: 0.5})
+        self.assertAlmostEqual(grad[x], 2 * np.exp(1.0) + np.exp(0.5))
+        self.assertAlmostEqual(grad[x], y.d({x: 0.5}))
+
+    def test_kernel_matches_backward(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        y = (x1 * x2).sin() + (5 / x2).exp() - x1.log() / x2.cos()
+        feed = {x1: 1.5, x2: 2.0}
+        graph = y.compile()
+        out = np.empty(len(graph.tape))
+        adjoint = np.empty(len(graph.tape))
+        var_grad = np.empty(len(graph.variables))
+        ad.eval_tape(graph.op_kind, graph.lhs, graph.rhs, graph.const_val,
+                     np.array([feed[v] for v in graph.variables]), out)
+        ad.grad_tape(graph.op_kind, graph.lhs, graph.rhs, graph.needs_grad,
+                     out, adjoint, var_grad)
+        grad = y.backward(feed)
+        for k, v in enumerate(graph.variables):
+            self.assertAlmostEqual(var_grad[k], grad[v])
+
+    def test_array_feed(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        y = x1 * x2.sin()
+        samples = np.linspace(0, 1, 7)
+        grad = y.backward({x1: samples, x2: 2.0})
+        np.testing.assert_allclose(grad[x1], np.full(7, np.sin(2.0)))
+        np.testing.assert_allclose(grad[x2], samples * np.cos(2.0))
+
+    def test_checkpointed_matches_full(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2')
+        y = x1
+        for _ in range(20):
+            y = (y * x2).sin() + x1 / x2
+        feed = {x1: 0.3, x2: 1.1}
+        grad = y.backward(feed)
+        for k in [1, 3, 7, 100]:
+            checkpointed = y.backward(feed, checkpoint_every=k)
+            self.assertAlmostEqual(checkpointed[x1], grad[x1])
+            self.assertAlmostEqual(checkpointed[x2], grad[x2])
+
+
+class TestGradFlag(unittest.TestCase):
+
+    def test_grad_propagates_from_either_operand(self):
+        x = ad.Variable('x')
+        c = ad.Constant(2.0)
+        self.assertTrue((x + c).grad)
+        self.assertTrue((c * x).grad)
+        self.assertTrue(x.sin().grad)
+        self.assertFalse((c + ad.Constant(1.0, grad=False)).grad)
+
+    def test_non_grad_variable_is_constant(self):
+        x1 = ad.Variable('x1')
+        x2 = ad.Variable('x2', grad=False)
+        y = x1 * x2 + x2.exp()
+        feed = {x1: 3.0, x2: 2.0}
+        self.assertAlmostEqual(y.d(feed), 2.0)
+        self.assertEqual(y.backward(feed), {x1: 2.0})
+
+
+if __name__ == '__main__':
+    unittest.main()